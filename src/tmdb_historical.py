@@ -5,26 +5,35 @@ TMDB DIY Project - Historical Script
 Goal:
 - Fetch popular movies and TV shows from roughly the last 6 months
 - Use TMDB Discover endpoint (not Trending)
-- Normalize results into a clean CSV for Power BI
+- Normalize results into a clean CSV (and Parquet) for Power BI
 - Create a by-genre CSV so genre charts are accurate
 
 Auth: uses TMDB V4 Read Access Token from env var TMDB_V4_TOKEN
 """
 
 import os
-import json
+import hashlib
+import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import Dict, Any, List, Optional
 
+import orjson
 import requests
 import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 # How far back to look for releases (in days)
 DAYS_BACK = 180
 # How many pages per media type to pull (20 results per page)
 PAGES = 5
+# How many TMDB requests may be in flight at once (well under the rate limit)
+MAX_WORKERS = 5
+# How long the on-disk genre map is reused before asking TMDB again (in days)
+GENRE_CACHE_DAYS = 30
 
 API_BASE = "https://api.themoviedb.org/3"
 HEADERS = {
@@ -35,30 +44,77 @@ HEADERS = {
 SCRIPT_DIR = Path(__file__).resolve().parent
 DATA_DIR = SCRIPT_DIR / "data"
 DATA_DIR.mkdir(parents=True, exist_ok=True)
+# Last ETag and body per request, used for conditional GETs on later runs
+HTTP_CACHE_DIR = SCRIPT_DIR / ".http_cache"
+
+# One pooled session for every TMDB call so keep-alive connections are reused.
+# Retry backs off on rate limits and server errors and honors Retry-After.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=1,
+            status_forcelist=(429, 500, 502, 503, 504),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        ),
+    ),
+)
 
 
 def fetch_json(path: str, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    """GET a TMDB v3 path with simple retries and backoff."""
+    """
+    GET a TMDB v3 path on the shared session (retries are handled by the adapter).
+    Bodies are cached by ETag so an unchanged response comes back as a 304 with no body.
+    """
     url = f"{API_BASE}{path}"
-    last_resp = None
-    for attempt in range(3):
-        resp = requests.get(url, headers=HEADERS, params=params or {})
-        if resp.status_code == 200:
-            return resp.json()
-        last_resp = resp
-        time.sleep(1 + attempt)
-    raise RuntimeError(f"HTTP {last_resp.status_code} for {url}: {last_resp.text[:300]}")
-
-
-def get_genre_map() -> Dict[int, str]:
-    """Build a single ID to name mapping across movie and TV genres."""
+    params = params or {}
+    key = hashlib.sha1(orjson.dumps([path, params], option=orjson.OPT_SORT_KEYS)).hexdigest()
+    etag_path = HTTP_CACHE_DIR / f"{key}.etag"
+    body_path = HTTP_CACHE_DIR / f"{key}.json"
+
+    headers = {}
+    if etag_path.exists() and body_path.exists():
+        headers["If-None-Match"] = etag_path.read_text(encoding="utf-8")
+    resp = SESSION.get(url, params=params, headers=headers, timeout=(5, 30))
+    if resp.status_code == 304:
+        return orjson.loads(body_path.read_bytes())
+    if resp.status_code != 200:
+        raise RuntimeError(f"HTTP {resp.status_code} for {url}: {resp.text[:300]}")
+
+    etag = resp.headers.get("ETag")
+    if etag:
+        HTTP_CACHE_DIR.mkdir(exist_ok=True)
+        body_path.write_bytes(resp.content)
+        etag_path.write_text(etag, encoding="utf-8")
+    return orjson.loads(resp.content)
+
+
+def get_genre_map(refresh: bool = False) -> Dict[int, str]:
+    """
+    Build a single ID to name mapping across movie and TV genres.
+    Reuses the cached JSON from a previous run unless it is stale or refresh is set.
+    """
+    cache_path = DATA_DIR / "genres_historical.json"
+    if (
+        not refresh
+        and cache_path.exists()
+        and time.time() - cache_path.stat().st_mtime < GENRE_CACHE_DAYS * 86400
+    ):
+        cached = orjson.loads(cache_path.read_bytes())
+        return {int(k): v for k, v in cached.items()}
+
     movie = fetch_json("/genre/movie/list")
     tv = fetch_json("/genre/tv/list")
     genre_map = {g["id"]: g["name"] for g in movie.get("genres", [])}
     genre_map.update({g["id"]: g["name"] for g in tv.get("genres", [])})
-    (DATA_DIR / "genres_historical.json").write_text(
-        json.dumps(genre_map, indent=2),
-        encoding="utf-8",
+    cache_path.write_bytes(
+        orjson.dumps(genre_map, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
     )
     return genre_map
 
@@ -92,18 +148,19 @@ def discover_range(
     else:
         return []
 
+    def fetch_page(page: int) -> List[Dict[str, Any]]:
+        return fetch_json(path, params={**base_params, "page": page}).get("results", [])
+
+    # Pages are requested concurrently but consumed in order,
+    # so we still stop at the first empty page.
     all_results: List[Dict[str, Any]] = []
-    for page in range(1, pages + 1):
-        params = dict(base_params)
-        params["page"] = page
-        data = fetch_json(path, params=params)
-        results = data.get("results", [])
-        if not results:
-            break
-        for r in results:
-            r["media_type"] = media_type
-        all_results.extend(results)
-        time.sleep(0.3)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        for results in pool.map(fetch_page, range(1, pages + 1)):
+            if not results:
+                break
+            for r in results:
+                r["media_type"] = media_type
+            all_results.extend(results)
     return all_results
 
 
@@ -112,53 +169,78 @@ def normalize_results(results: List[Dict[str, Any]], genre_map: Dict[int, str])
     Create a tidy DataFrame with common fields across movie and TV rows.
     Maps genre_ids to a semicolon joined genre_names.
     """
-    rows = []
+    # Bind the lookups used in the per-row genre join once, outside the loop.
+    # Names are memoized in a local copy so an unknown id is stringified only once.
+    names = dict(genre_map)
+    name_get = names.get
+    name_set = names.setdefault
+    _str = str
+    _join = "; ".join
+
+    # Build each column in one pass so pandas can take the column-oriented
+    # constructor path instead of inferring a schema from per-row dicts.
+    origin_country_codes = []
     for r in results:
-        media_type = r.get("media_type")
-        title = r.get("title") or r.get("name")
-        date = r.get("release_date") or r.get("first_air_date")
-        genre_ids = r.get("genre_ids") or []
-        genres = [genre_map.get(gid, str(gid)) for gid in genre_ids]
         origin_country = r.get("origin_country")
         if isinstance(origin_country, list) and origin_country:
-            origin_country_code = origin_country[0]   # for example "US"
+            origin_country_codes.append(origin_country[0])   # for example "US"
         else:
-            origin_country_code = None
-        rows.append(
-            {
-                "id": r.get("id"),
-                "media_type": media_type,
-                "title": title,
-                "date": date,
-                "popularity": r.get("popularity"),
-                "vote_average": r.get("vote_average"),
-                "vote_count": r.get("vote_count"),
-                "original_language": r.get("original_language"),
-                "origin_country_code": origin_country_code,
-                "genres": "; ".join(genres),
-            }
-        )
-    df = pd.DataFrame(rows)
-    if not df.empty:
-        df = df.sort_values(by=["popularity"], ascending=False, kind="mergesort").reset_index(drop=True)
+            origin_country_codes.append(None)
+    df = pd.DataFrame(
+        {
+            "id": [r.get("id") for r in results],
+            "media_type": [r.get("media_type") for r in results],
+            "title": [r.get("title") or r.get("name") for r in results],
+            "date": [r.get("release_date") or r.get("first_air_date") for r in results],
+            "popularity": [r.get("popularity") for r in results],
+            "vote_average": [r.get("vote_average") for r in results],
+            "vote_count": [r.get("vote_count") for r in results],
+            "original_language": [r.get("original_language") for r in results],
+            "origin_country_code": origin_country_codes,
+            "genres": [
+                _join([name_get(gid) or name_set(gid, _str(gid)) for gid in (r.get("genre_ids") or ())])
+                for r in results
+            ],
+        }
+    )
+    # Low-cardinality labels as categoricals: smaller in memory, dictionary-encoded in Parquet
+    for col in ("media_type", "original_language"):
+        df[col] = df[col].astype("category")
     return df
 
 
 def expand_by_genre(df: pd.DataFrame) -> pd.DataFrame:
     """Split the semicolon list in 'genres' into one row per genre for accurate counts."""
-    out_rows = []
-    for _, r in df.iterrows():
-        g_list = [x.strip() for x in str(r["genres"]).split(";") if x and x.strip()]
-        if not g_list:
-            rr = r.copy()
-            rr["genre"] = ""
-            out_rows.append(rr)
+    g_lists = df["genres"].fillna("").astype(str).map(
+        lambda s: [x.strip() for x in s.split(";") if x.strip()]
+    )
+    out = df.assign(genre=g_lists).explode("genre", ignore_index=True)
+    # Rows without any genre explode to NaN; keep them with an empty genre
+    out["genre"] = out["genre"].fillna("").astype("category")
+    return out
+
+
+def save_outputs(df: pd.DataFrame, name: str, stamp: str) -> None:
+    """
+    Write df as CSV and Parquet under a dated name, then expose the same
+    files under a stable '_latest' name for Power BI.
+    """
+    for ext in (".csv", ".parquet"):
+        dated_path = DATA_DIR / f"{name}_{stamp}{ext}"
+        if ext == ".csv":
+            df.to_csv(dated_path, index=False, encoding="utf-8")
         else:
-            for g in g_list:
-                rr = r.copy()
-                rr["genre"] = g
-                out_rows.append(rr)
-    return pd.DataFrame(out_rows)
+            df.to_parquet(dated_path, compression="zstd", index=False)
+        print(f"Saved {name} {ext[1:]} to {dated_path.resolve()}")
+
+        # Serialize once; the latest file is a hard link (or a copy where links are unsupported)
+        latest_path = DATA_DIR / f"{name}_latest{ext}"
+        latest_path.unlink(missing_ok=True)
+        try:
+            os.link(dated_path, latest_path)
+        except OSError:
+            shutil.copyfile(dated_path, latest_path)
+        print(f"Saved {name} {ext[1:]} to {latest_path.resolve()}")
 
 
 def main():
@@ -175,17 +257,22 @@ def main():
 
     print(f"Building historical dataset from {start_s} to {end_s}")
 
-    genre_map = get_genre_map()
+    # Genres, movies and tv are independent, so fetch them side by side
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        genre_future = pool.submit(get_genre_map)
+        movie_future = pool.submit(discover_range, "movie", start_s, end_s, pages=PAGES)
+        tv_future = pool.submit(discover_range, "tv", start_s, end_s, pages=PAGES)
+    genre_map = genre_future.result()
 
     all_results: List[Dict[str, Any]] = []
 
     # movies
-    movie_results = discover_range("movie", start_s, end_s, pages=PAGES)
+    movie_results = movie_future.result()
     print(f"Fetched {len(movie_results)} movie rows")
     all_results.extend(movie_results)
 
     # tv
-    tv_results = discover_range("tv", start_s, end_s, pages=PAGES)
+    tv_results = tv_future.result()
     print(f"Fetched {len(tv_results)} tv rows")
     all_results.extend(tv_results)
 
@@ -193,28 +280,20 @@ def main():
         print("No results fetched for historical range.")
         return
 
+    # A checkout resets file times, so the cache can look fresh while missing
+    # genres TMDB added since; refetch once if any id is unknown.
+    if any(gid not in genre_map for r in all_results for gid in r.get("genre_ids") or []):
+        genre_map = get_genre_map(refresh=True)
+
     df = normalize_results(all_results, genre_map)
+    # Sort once on the combined movie + TV frame; stable so ties keep fetch order
+    df = df.sort_values(by=["popularity"], ascending=False, kind="mergesort", ignore_index=True)
     print(f"Total normalized rows: {len(df)}")
 
-    # Save clean historical CSV with a date stamp
-    clean_path = DATA_DIR / f"historical_all_clean_{stamp}.csv"
-    df.to_csv(clean_path, index=False, encoding="utf-8")
-    print(f"Saved historical clean CSV to {clean_path.resolve()}")
-
-    # Also save a stable name for Power BI
-    latest_clean_path = DATA_DIR / "historical_all_clean_latest.csv"
-    df.to_csv(latest_clean_path, index=False, encoding="utf-8")
-    print(f"Saved historical clean CSV to {latest_clean_path.resolve()}")
-
-    # By genre
+    # Clean historical snapshot, plus a by-genre version so genre charts are accurate
+    save_outputs(df, "historical_all_clean", stamp)
     df_by_genre = expand_by_genre(df)
-    by_genre_path = DATA_DIR / f"historical_all_by_genre_{stamp}.csv"
-    df_by_genre.to_csv(by_genre_path, index=False, encoding="utf-8")
-    print(f"Saved historical by-genre CSV to {by_genre_path.resolve()}")
-
-    latest_by_genre_path = DATA_DIR / "historical_all_by_genre_latest.csv"
-    df_by_genre.to_csv(latest_by_genre_path, index=False, encoding="utf-8")
-    print(f"Saved historical by-genre CSV to {latest_by_genre_path.resolve()}")
+    save_outputs(df_by_genre, "historical_all_by_genre", stamp)
 
 
 if __name__ == "__main__":